@@ -1,13 +1,42 @@
 import os
-from typing import List, Dict, Literal, Optional
+import re
+import logging
+import time
+import threading
+import asyncio
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+from typing import Any, AsyncIterator, Iterator, Awaitable, Callable, List, Dict, Literal, Optional, Set, Tuple
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from groq import Groq
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict, Field
+from cachetools import TTLCache
+from groq import AsyncGroq, APIStatusError, APITimeoutError
+import httpx
+import orjson
+import redis.asyncio as redis
+from redis.exceptions import LockError
+import tiktoken
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 load_dotenv()
 
+# Read by tiktoken at load time; the build step pre-populates this directory.
+os.environ.setdefault(
+    "TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tiktoken_cache")
+)
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 # -------- Config --------
 GROQ_API_KEY: Optional[str] = os.getenv("GROQ_API_KEY")
 
@@ -25,9 +54,95 @@ else:
 MODEL_NAME = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "512"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "0"))  # 0 = pass-through (default)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+FAQ_ENABLED = os.getenv("FAQ_ENABLED", "0") == "1"  # opt-in; needs sentence-transformers installed
+FAQ_MODEL = os.getenv("FAQ_MODEL", "all-MiniLM-L6-v2")
+FAQ_BACKEND = os.getenv("FAQ_BACKEND", "onnx")
+FAQ_THRESHOLD = float(os.getenv("FAQ_THRESHOLD", "0.80"))
+GROQ_MAX_ATTEMPTS = int(os.getenv("GROQ_MAX_ATTEMPTS", "3"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))  # seconds to fast-fail once tripped
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+SUMMARIZE_AFTER_DROPPED = 8  # summarise instead of silently dropping more than this many messages
+SUMMARY_MAX_TOKENS = 256
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "10000"))
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "3600"))  # seconds idle before eviction
+REDIS_URL: Optional[str] = os.getenv("REDIS_URL")  # shared session store for multi-worker deploys
+TURN_LOCK_TIMEOUT = float(os.getenv("TURN_LOCK_TIMEOUT", "120"))  # seconds; must outlast a full turn
+
+# -------- System Prompt --------
+# Invariant: messages[0] of every conversation is this exact string object, byte-for-byte
+# identical across sessions, so Groq's prompt prefix cache covers it on every call.
+# Dynamic context (summaries, per-user facts) goes in later messages, never into index 0.
+SYSTEM_PROMPT: str = (
+    "You are Sabrang Assistant, the official AI helper for SABRANG 2025 - JK Lakshmipat "
+    "University's premier annual cultural and technical fest. Provide accurate, helpful, "
+    "concise information. You can cover: events, categories, dates, timings; registration "
+    "process/fees; rules/rounds/judgement criteria; workshops; pro-shows; campus/directions/"
+    "accommodation; contacts; sponsorship; highlights/theme; committees.\n\n"
+    "Theme: Noorvana – light, positivity, new beginnings. 3-day extravaganza of music, "
+    "dance, gaming, art, innovation.\n\n"
+    "Key contacts:\n"
+    "- Organizing Head: Diya Garg (+91 72968 59397)\n"
+    "- Registration Core: Jayash Gahlot (+91 83062 74199), Ayushi Kabra (+91 93523 06947)\n"
+    "- Official Website: https://sabrang.jklu.edu.in\n\n"
+    "Be friendly, enthusiastic, factual. Redirect unrelated queries back to Sabrang."
+)
+SYSTEM_HASH: str = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+# Read-only template shared by every Conversation (see Conversation.system_message).
+SYSTEM_MESSAGE = MappingProxyType({"role": "system", "content": SYSTEM_PROMPT})
+
+# -------- FAQ Catalogue --------
+# Canned answers built only from facts stated in SYSTEM_PROMPT, each with a few phrasings
+# to match against. Anything not covered here falls through to Groq.
+FAQ_ENTRIES: List[Tuple[Tuple[str, ...], str]] = [
+    (
+        ("What is Sabrang?", "Tell me about Sabrang", "What is SABRANG 2025?"),
+        "SABRANG 2025 is JK Lakshmipat University's premier annual cultural and technical fest - "
+        "a 3-day extravaganza of music, dance, gaming, art and innovation. More at https://sabrang.jklu.edu.in",
+    ),
+    (
+        ("What is the theme?", "What is Noorvana?", "What is this year's theme of Sabrang?"),
+        "This year's theme is Noorvana - light, positivity and new beginnings.",
+    ),
+    (
+        ("What is the official website?", "Sabrang website link", "Where can I find more details online?"),
+        "The official website is https://sabrang.jklu.edu.in",
+    ),
+    (
+        ("Who should I contact?", "Contact details", "Give me the contact numbers", "Who is the organizing head?"),
+        "Key contacts for Sabrang:\n"
+        "- Organizing Head: Diya Garg (+91 72968 59397)\n"
+        "- Registration Core: Jayash Gahlot (+91 83062 74199), Ayushi Kabra (+91 93523 06947)",
+    ),
+    (
+        ("Who do I contact for registration?", "Registration help contact", "Whom to call about registration?"),
+        "For registration queries, reach the Registration Core: Jayash Gahlot (+91 83062 74199) "
+        "or Ayushi Kabra (+91 93523 06947). Details are also on https://sabrang.jklu.edu.in",
+    ),
+    (
+        ("How long is Sabrang?", "How many days is the fest?"),
+        "Sabrang is a 3-day fest packed with music, dance, gaming, art and innovation.",
+    ),
+]
 
 # -------- App --------
-app = FastAPI(title="Sabrang Assistant API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global faq_matcher
+    # Loaded per worker, after any fork: torch/onnxruntime thread pools started in a
+    # preloading master can hang inference in the forked children.
+    faq_matcher = await run_in_threadpool(_load_faq_matcher)
+    yield
+    await batcher.close()
+    if client is not None:
+        await client.close()
+    if rdb is not None:
+        await rdb.aclose()
+
+app = FastAPI(title="Sabrang Assistant API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,113 +153,689 @@ app.add_middleware(
 )
 
 # -------- Groq Client --------
-client: Optional[Groq] = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+# One shared async client per worker, built at import and reused for its lifetime.
+# HTTP/2 multiplexes in-flight completions over few connections; a warm keepalive
+# pool avoids fresh TLS handshakes under bursty load. Retries are handled below,
+# so the SDK's own retry loop is disabled.
+client: Optional[AsyncGroq] = (
+    AsyncGroq(
+        api_key=GROQ_API_KEY,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=httpx.Timeout(20.0, connect=3.0),
+        ),
+    )
+    if GROQ_API_KEY
+    else None
+)
 if not GROQ_API_KEY:
-    print("[WARN] GROQ_API_KEY not set. /chat/ will return 503 until configured.")
+    logger.warning("GROQ_API_KEY not set; /chat/ will return 503 until configured.")
+
+# -------- Retry / Circuit Breaker --------
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, (APITimeoutError, httpx.TimeoutException))
+
+retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    stop=stop_after_attempt(GROQ_MAX_ATTEMPTS),
+    wait=wait_random_exponential(multiplier=0.5, max=4),
+    reraise=True,
+)
+
+class CircuitBreaker:
+    """Fast-fails Groq calls for a cooldown window after repeated transient failures."""
+
+    def __init__(self, failure_threshold: int, cooldown: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        # Once the cooldown has passed, calls are let through again as trials.
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error("Circuit breaker open after %d consecutive Groq failures", self.failures)
+            self.opened_at = time.monotonic()
+
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+
+def _check_groq_available() -> None:
+    if client is None:
+        raise HTTPException(status_code=503, detail="Groq API client not initialized (missing GROQ_API_KEY).")
+    if not breaker.allow():
+        raise HTTPException(status_code=503, detail="Groq API temporarily unavailable. Please retry shortly.")
+
+# -------- Request Batcher --------
+Messages = List[Dict[str, str]]
+
+class Batcher:
+    """Coalesces completion requests arriving within a short window and dispatches them together.
+
+    Each batch is fired concurrently over the shared client pool; batches are not awaited by the
+    collector, so a slow completion never holds up requests queued behind it.
+
+    Groq has no batch completion endpoint, so every item is still its own HTTP request and the
+    HTTP/2 pool already multiplexes them: a non-zero window only adds latency. It is off by
+    default and kept for pacing experiments.
+    """
+
+    def __init__(self, create: Callable[[Messages], Awaitable[Any]], window_ms: float, max_size: int) -> None:
+        self._create = create
+        self._window = window_ms / 1000.0
+        self._max_size = max(1, max_size)
+        self._queue: "Optional[asyncio.Queue[Tuple[asyncio.Future, Messages]]]" = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+    async def submit(self, messages: Messages) -> Any:
+        if self._window <= 0:
+            return await self._create(messages)
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((future, messages))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._window
+            while len(batch) < self._max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[Tuple[asyncio.Future, Messages]]) -> None:
+        results = await asyncio.gather(*(self._create(m) for _, m in batch), return_exceptions=True)
+        for (future, _), result in zip(batch, results):
+            if future.done():  # caller went away
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self) -> None:
+        tasks = list(self._inflight) + ([self._worker] if self._worker else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+
+@retry_transient
+async def _create_completion(messages: Messages) -> Any:
+    return await client.chat.completions.create(
+        model=MODEL_NAME,
+        messages=messages,
+        temperature=TEMPERATURE,
+        max_tokens=MAX_TOKENS,
+        top_p=1,
+        stream=False,
+    )
+
+batcher = Batcher(_create_completion, window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE)
 
 # -------- Data Models --------
 Role = Literal["user", "assistant", "system"]
 
 class UserInput(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, extra="forbid")
+
     message: str = Field(..., min_length=1)
     role: Role = "user"
     conversation_id: str = Field(..., min_length=3)
 
+_ROLE_NAMES: Tuple[Role, ...] = ("system", "user", "assistant")
+_ROLE_IDS: Dict[str, int] = {name: i for i, name in enumerate(_ROLE_NAMES)}
+
+class ChatResponse(BaseModel):
+    response: str
+    conversation_id: str
+
+class HealthResponse(BaseModel):
+    ok: bool
+    model: str
+    has_api_key: bool
+    allowed_origins: List[str]
+
 class Conversation:
+    """Chat history kept as parallel role-id / content ring buffers.
+
+    The system prompt lives once on the class. Turns move around as (role, content)
+    tuples; the dict list Groq expects is only built by as_messages() right before a call.
+    """
+
+    system_message = SYSTEM_MESSAGE
+
     def __init__(self) -> None:
-        self.messages: List[Dict[str, str]] = [
-            {
-                "role": "system",
-                "content": (
-                    "You are Sabrang Assistant, the official AI helper for SABRANG 2025 - JK Lakshmipat "
-                    "University's premier annual cultural and technical fest. Provide accurate, helpful, "
-                    "concise information. You can cover: events, categories, dates, timings; registration "
-                    "process/fees; rules/rounds/judgement criteria; workshops; pro-shows; campus/directions/"
-                    "accommodation; contacts; sponsorship; highlights/theme; committees.\n\n"
-                    "Theme: Noorvana – light, positivity, new beginnings. 3-day extravaganza of music, "
-                    "dance, gaming, art, innovation.\n\n"
-                    "Key contacts:\n"
-                    "- Organizing Head: Diya Garg (+91 72968 59397)\n"
-                    "- Registration Core: Jayash Gahlot (+91 83062 74199), Ayushi Kabra (+91 93523 06947)\n"
-                    "- Official Website: https://sabrang.jklu.edu.in\n\n"
-                    "Be friendly, enthusiastic, factual. Redirect unrelated queries back to Sabrang."
-                ),
-            }
-        ]
         self.active: bool = True
-        self.max_history: int = 30  # cap growth
+        self.max_history: int = 30  # cap growth; the oldest turns fall off the buffers
+        self.roles: "deque[int]" = deque(maxlen=self.max_history)
+        self.contents: "deque[str]" = deque(maxlen=self.max_history)
+        # Token counts are computed once on append; older messages never change.
+        self.token_counts: "deque[int]" = deque(maxlen=self.max_history)
+        self.summary: Optional[str] = None  # folded-in older turns, see trim_history
+        self.summary_tokens: int = 0
 
     def add(self, role: Role, content: str) -> None:
-        self.messages.append({"role": role, "content": content})
-        # Keep last N messages + system
-        if len(self.messages) > self.max_history + 1:
-            # preserve first system message
-            system = self.messages[0]
-            self.messages = [system] + self.messages[-self.max_history:]
+        self.roles.append(_ROLE_IDS[role])
+        self.contents.append(content)
+        self.token_counts.append(_count_tokens(content))
+
+    def popleft(self) -> Tuple[str, str]:
+        self.token_counts.popleft()
+        return _ROLE_NAMES[self.roles.popleft()], self.contents.popleft()
+
+    def set_summary(self, summary: Optional[str]) -> None:
+        self.summary = summary
+        self.summary_tokens = _count_tokens(self._summary_content()) if summary else 0
+
+    def _summary_content(self) -> str:
+        return f"Earlier summary: {self.summary}"
+
+    @property
+    def total_tokens(self) -> int:
+        return SYSTEM_TOKENS + self.summary_tokens + sum(self.token_counts)
+
+    def history(self) -> Iterator[Tuple[str, str]]:
+        yield self.system_message["role"], self.system_message["content"]
+        if self.summary:
+            yield "system", self._summary_content()
+        for r, c in zip(self.roles, self.contents):
+            yield _ROLE_NAMES[r], c
+
+    def as_messages(self) -> Messages:
+        return [{"role": r, "content": c} for r, c in self.history()]
+
+    def to_json(self) -> bytes:
+        return orjson.dumps({
+            "active": self.active,
+            "roles": list(self.roles),
+            "contents": list(self.contents),
+            "token_counts": list(self.token_counts),
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+        })
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "Conversation":
+        data = orjson.loads(raw)
+        convo = cls()
+        convo.active = data["active"]
+        convo.roles.extend(data["roles"])
+        convo.contents.extend(data["contents"])
+        convo.token_counts.extend(data["token_counts"])
+        convo.summary = data["summary"]
+        convo.summary_tokens = data["summary_tokens"]
+        return convo
+
+# -------- Session Store --------
+# With REDIS_URL set, sessions live in Redis so every worker/replica sees the same history.
+# Otherwise they stay in this process: sessions are re-inserted on every access, so the
+# least recently used one is evicted at capacity and idle ones expire after CONVERSATION_TTL.
+rdb: "Optional[redis.Redis]" = redis.from_url(REDIS_URL) if REDIS_URL else None
+conversations: "TTLCache[str, Conversation]" = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL)
+
+# Turns are serialised per conversation_id so concurrent requests can't interleave history:
+# by an asyncio.Lock within this process, plus a Redis lock across workers/replicas when
+# sessions live in Redis. Registry lookup and insert have no await between them, so they can't race.
+conversation_locks: "TTLCache[str, asyncio.Lock]" = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL)
+
+class ConversationBusy(Exception):
+    """Another worker held the conversation's turn lock for longer than TURN_LOCK_TIMEOUT."""
+
+def _local_lock(conversation_id: str) -> asyncio.Lock:
+    lock = conversation_locks.get(conversation_id)
+    if lock is None:
+        lock = asyncio.Lock()
+    conversation_locks[conversation_id] = lock
+    return lock
+
+@asynccontextmanager
+async def conversation_turn(conversation_id: str) -> AsyncIterator[None]:
+    """Hold the conversation exclusively for one load -> update -> save turn."""
+    async with _local_lock(conversation_id):
+        if rdb is None:
+            yield
+            return
+        lock = rdb.lock(
+            f"lock:{_redis_key(conversation_id)}",
+            timeout=TURN_LOCK_TIMEOUT,
+            blocking_timeout=TURN_LOCK_TIMEOUT,
+        )
+        if not await lock.acquire():
+            raise ConversationBusy(conversation_id)
+        try:
+            yield
+        finally:
+            try:
+                await lock.release()
+            except LockError:
+                # Expired mid-turn; another worker may have interleaved with this one.
+                logger.warning("Turn lock for conversation %s expired before release", conversation_id)
+
+def _redis_key(conversation_id: str) -> str:
+    return f"conv:{conversation_id}"
+
+# -------- Response Cache --------
+CacheKey = Tuple[str, str]
+
+def _norm(message: str) -> str:
+    return re.sub(r"\s+", " ", message.strip().lower())
+
+class ResponseCache:
+    """Bounded LRU of replies to opening questions, keyed on (system prompt hash, message)."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data: "OrderedDict[CacheKey, str]" = OrderedDict()
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        reply = self._data.get(key)
+        if reply is not None:
+            self._data.move_to_end(key)
+        return reply
+
+    def __setitem__(self, key: CacheKey, reply: str) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = reply
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
 
-conversations: Dict[str, Conversation] = {}
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
 
-def get_or_create_conversation(conversation_id: str) -> Conversation:
+def response_cache_key(conversation: Conversation, input: UserInput) -> Optional[CacheKey]:
+    # Only the first user turn is answered from the prompt alone; later turns depend on history.
+    if input.role != "user" or conversation.contents or conversation.summary:
+        return None
+    return (SYSTEM_HASH, _norm(input.message))
+
+async def get_or_create_conversation(conversation_id: str) -> Conversation:
+    if rdb is not None:
+        raw = await rdb.get(_redis_key(conversation_id))
+        return Conversation.from_json(raw) if raw else Conversation()
     convo = conversations.get(conversation_id)
     if not convo:
         convo = Conversation()
-        conversations[conversation_id] = convo
+    # Re-insert on every access so the TTL measures idle time, not session age.
+    conversations[conversation_id] = convo
     return convo
 
-# -------- Groq Call --------
-def query_groq_api(conversation: Conversation) -> str:
-    if client is None:
-        raise HTTPException(status_code=503, detail="Groq API client not initialized (missing GROQ_API_KEY).")
+async def save_conversation(conversation_id: str, convo: Conversation) -> None:
+    if rdb is not None:
+        await rdb.set(_redis_key(conversation_id), convo.to_json(), ex=CONVERSATION_TTL)
+    else:
+        conversations[conversation_id] = convo
+
+# -------- FAQ Fast Path --------
+class FaqMatcher:
+    """Answers catalogue questions locally by cosine similarity of sentence embeddings."""
+
+    def __init__(self, model: Any, entries: List[Tuple[Tuple[str, ...], str]], threshold: float) -> None:
+        self.model = model
+        self.threshold = threshold
+        questions = [q for qs, _ in entries for q in qs]
+        self.answers = [a for qs, a in entries for _ in qs]
+        self.embeddings = model.encode(questions, normalize_embeddings=True)
+
+    def match(self, message: str) -> Optional[str]:
+        query = self.model.encode([message], normalize_embeddings=True)[0]
+        sims = self.embeddings @ query
+        best = int(sims.argmax())
+        return self.answers[best] if sims[best] > self.threshold else None
+
+def _load_faq_matcher() -> Optional[FaqMatcher]:
+    if not FAQ_ENABLED:
+        return None
+    try:  # optional dependency, imported lazily for the same fork-safety reason
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        logger.warning("FAQ_ENABLED is set but sentence-transformers is not installed; FAQ fast path disabled")
+        return None
+    try:
+        try:
+            model = SentenceTransformer(FAQ_MODEL, backend=FAQ_BACKEND)
+        except Exception as e:
+            logger.warning("FAQ model backend %s unavailable, using default: %s", FAQ_BACKEND, e)
+            model = SentenceTransformer(FAQ_MODEL)
+        return FaqMatcher(model, FAQ_ENTRIES, FAQ_THRESHOLD)
+    except Exception as e:
+        logger.warning("FAQ fast path disabled: %s", e)
+        return None
+
+# Set by the lifespan handler once each worker has started.
+faq_matcher: Optional[FaqMatcher] = None
+
+async def faq_answer(conversation: Conversation, input: UserInput) -> Optional[str]:
+    # Like the response cache, only opening questions: mid-conversation follow-ups
+    # ("who should I contact?") depend on what was discussed before.
+    if faq_matcher is None or input.role != "user" or conversation.contents or conversation.summary:
+        return None
+    # Embedding is CPU-bound; keep it off the event loop.
+    return await run_in_threadpool(faq_matcher.match, input.message)
+
+# -------- History Budget --------
+MESSAGE_OVERHEAD_TOKENS = 4  # role/separator tokens per chat message
+
+ENCODER_LOAD_TIMEOUT = float(os.getenv("ENCODER_LOAD_TIMEOUT", "5"))  # seconds
+
+def _load_encoding(timeout: float) -> "Optional[tiktoken.Encoding]":
+    """Load cl100k_base once, waiting at most `timeout` seconds.
+
+    tiktoken reads the file from TIKTOKEN_CACHE_DIR (filled at build time, see railway.json)
+    and only falls back to an HTTP download without a timeout of its own, so the load runs
+    on a daemon thread that is abandoned if it doesn't finish in time.
+    """
+    result: List["tiktoken.Encoding"] = []
+    errors: List[BaseException] = []
+
+    def load() -> None:
+        try:
+            result.append(tiktoken.get_encoding("cl100k_base"))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=load, name="tiktoken-load", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if result:
+        return result[0]
+    reason = errors[0] if errors else f"timed out after {timeout:.0f}s"
+    logger.warning(
+        "tiktoken encoding unavailable (%s); estimating tokens from length. "
+        "Populate TIKTOKEN_CACHE_DIR=%s at build time to avoid this.",
+        reason, os.environ.get("TIKTOKEN_CACHE_DIR"),
+    )
+    return None
+
+# cl100k_base only approximates Llama's tokenizer, which is close enough for a budget.
+# Loaded once at import: under `gunicorn --preload` that happens in the master, so the
+# encoder tables (like SYSTEM_PROMPT) are shared copy-on-write by every forked worker
+# and the request path never touches the network.
+_encoding: "Optional[tiktoken.Encoding]" = _load_encoding(ENCODER_LOAD_TIMEOUT)
+
+def _count_tokens(content: str) -> int:
+    n = len(_encoding.encode(content)) if _encoding is not None else len(content) // 4
+    return n + MESSAGE_OVERHEAD_TOKENS
+
+SYSTEM_TOKENS: int = _count_tokens(SYSTEM_PROMPT)
+
+async def summarize_messages(turns: List[Tuple[str, str]]) -> Optional[str]:
+    transcript = "\n".join(f"{role}: {content}" for role, content in turns)
     try:
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model=MODEL_NAME,
-            messages=conversation.messages,
-            temperature=TEMPERATURE,
-            max_tokens=MAX_TOKENS,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarise this conversation in a few sentences, keeping names, "
+                               "events and any facts the user asked about.",
+                },
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0.2,
+            max_tokens=SUMMARY_MAX_TOKENS,
             top_p=1,
             stream=False,
         )
-        content = completion.choices[0].message.content
-        if not content or not content.strip():
-            raise HTTPException(status_code=500, detail="Empty response from Groq API.")
-        return content.strip()
-    except HTTPException:
-        raise
     except Exception as e:
+        # A summary is best-effort; the turn proceeds without it.
+        logger.warning("History summary failed: %s", e)
+        if _is_transient(e):
+            breaker.record_failure()
+        return None
+    breaker.record_success()
+    content = completion.choices[0].message.content
+    return content.strip() if content and content.strip() else None
+
+async def trim_history(conversation: Conversation) -> None:
+    """Drop the oldest turns until the prompt fits HISTORY_TOKEN_BUDGET.
+
+    The system prompt and the newest message are always kept. Dropped turns are folded
+    into a running summary placed right after the system prompt: one is started when many
+    messages fall out at once, and once it exists every later trim extends it. The summary
+    itself is only discarded as a last resort.
+    """
+    total = conversation.total_tokens
+    if total <= HISTORY_TOKEN_BUDGET:
+        return
+    dropped: List[Tuple[str, str]] = []
+
+    def drop_until(limit: int) -> None:
+        nonlocal total
+        while total > limit and len(conversation.contents) > 1:
+            total -= conversation.token_counts[0]
+            dropped.append(conversation.popleft())
+
+    drop_until(HISTORY_TOKEN_BUDGET)
+    if dropped and client is not None and (conversation.summary or len(dropped) > SUMMARIZE_AFTER_DROPPED):
+        # The new summary replaces the current one; leave room for it at its maximum length.
+        total -= conversation.summary_tokens
+        drop_until(HISTORY_TOKEN_BUDGET - SUMMARY_MAX_TOKENS - _count_tokens("Earlier summary: "))
+        prior = [("system", conversation._summary_content())] if conversation.summary else []
+        summary = await summarize_messages(prior + dropped)
+        if summary:
+            conversation.set_summary(summary)
+
+    # The summary can run over its estimate (or a failed call kept the old one): enforce the budget.
+    total = conversation.total_tokens
+    dropped.clear()
+    drop_until(HISTORY_TOKEN_BUDGET)
+    if total > HISTORY_TOKEN_BUDGET and conversation.summary:
+        conversation.set_summary(None)
+
+# -------- Groq Call --------
+def _check_prefix(messages: Messages) -> None:
+    # Explicit check rather than assert, so it still runs under python -O.
+    if messages[0]["content"] is not SYSTEM_PROMPT:
+        raise RuntimeError("system prompt prefix was modified")
+
+async def query_groq_api(conversation: Conversation) -> str:
+    _check_groq_available()
+    messages = conversation.as_messages()
+    _check_prefix(messages)
+    try:
+        completion = await batcher.submit(messages)
+    except Exception as e:
+        logger.warning("Groq completion failed: %s", e)
+        if _is_transient(e):
+            breaker.record_failure()
+            raise HTTPException(status_code=503, detail=f"Groq API unavailable: {e}")
         raise HTTPException(status_code=500, detail=f"Error with Groq API: {e}")
+    breaker.record_success()
+    content = completion.choices[0].message.content
+    if not content or not content.strip():
+        raise HTTPException(status_code=500, detail="Empty response from Groq API.")
+    return content.strip()
+
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    payload = orjson.dumps(data).decode()
+    return f"event: {event}\ndata: {payload}\n\n" if event else f"data: {payload}\n\n"
+
+@retry_transient
+async def _open_stream(messages: Messages) -> Any:
+    # Only opening the stream is retried; once tokens flow a failure is reported in-band.
+    return await client.chat.completions.create(
+        model=MODEL_NAME,
+        messages=messages,
+        temperature=TEMPERATURE,
+        max_tokens=MAX_TOKENS,
+        top_p=1,
+        stream=True,
+    )
+
+async def stream_groq(conversation: Conversation, cache_key: Optional[CacheKey] = None) -> AsyncIterator[str]:
+    """Yield the reply as Server-Sent Events, then record it in the history."""
+    messages = conversation.as_messages()
+    _check_prefix(messages)
+    parts: List[str] = []
+    try:
+        stream = await _open_stream(messages)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                yield _sse({"delta": delta})
+    except Exception as e:
+        logger.warning("Groq stream failed: %s", e)
+        if _is_transient(e):
+            breaker.record_failure()
+        # Headers are already sent, so report the failure in-band.
+        yield _sse({"detail": f"Error with Groq API: {e}"}, event="error")
+        return
+
+    breaker.record_success()
+    reply = "".join(parts).strip()
+    if not reply:
+        yield _sse({"detail": "Empty response from Groq API."}, event="error")
+        return
+    conversation.add(role="assistant", content=reply)
+    if cache_key is not None:
+        response_cache[cache_key] = reply
+    yield _sse({}, event="done")
+
+async def find_local_reply(conversation: Conversation, input: UserInput) -> Tuple[Optional[CacheKey], Optional[str]]:
+    """Answer from the response cache or the FAQ catalogue, without going to Groq."""
+    cache_key = response_cache_key(conversation, input)
+    local_reply = response_cache.get(cache_key) if cache_key else None
+    if local_reply is None:
+        local_reply = await faq_answer(conversation, input)
+    return cache_key, local_reply
+
+async def stream_chat(input: UserInput) -> AsyncIterator[str]:
+    # The lock is held for the whole turn, including while tokens are streamed.
+    try:
+        async with conversation_turn(input.conversation_id):
+            async for event in _stream_turn(input):
+                yield event
+    except ConversationBusy:
+        yield _sse({"detail": "Conversation is busy with another message. Please retry."}, event="error")
+
+async def _stream_turn(input: UserInput) -> AsyncIterator[str]:
+    conversation = await get_or_create_conversation(input.conversation_id)
+    if not conversation.active:
+        yield _sse({"detail": "Chat session ended. Please start a new session."}, event="error")
+        return
+    cache_key, local_reply = await find_local_reply(conversation, input)
+    if local_reply is None:
+        try:
+            _check_groq_available()
+        except HTTPException as e:
+            yield _sse({"detail": e.detail}, event="error")
+            return
+
+    conversation.add(role=input.role, content=input.message)
+
+    if local_reply is not None:
+        conversation.add(role="assistant", content=local_reply)
+        await save_conversation(input.conversation_id, conversation)
+        yield _sse({"delta": local_reply})
+        yield _sse({}, event="done")
+        return
+
+    await trim_history(conversation)
+    async for event in stream_groq(conversation, cache_key):
+        yield event
+    await save_conversation(input.conversation_id, conversation)
 
 # -------- Routes --------
+@app.exception_handler(ConversationBusy)
+async def conversation_busy_handler(request: Request, exc: ConversationBusy) -> JSONResponse:
+    return JSONResponse(
+        status_code=409,
+        content={"detail": "Conversation is busy with another message. Please retry."},
+    )
+
 @app.get("/health")
-def health():
-    return {
-        "ok": True,
-        "model": MODEL_NAME,
-        "has_api_key": bool(GROQ_API_KEY),
-        "allowed_origins": ALLOWED_ORIGINS,
-    }
+def health() -> HealthResponse:
+    return HealthResponse(
+        ok=True,
+        model=MODEL_NAME,
+        has_api_key=bool(GROQ_API_KEY),
+        allowed_origins=ALLOWED_ORIGINS,
+    )
 
 @app.post("/chat/")
-def chat(input: UserInput):
-    conversation = get_or_create_conversation(input.conversation_id)
-    if not conversation.active:
-        raise HTTPException(status_code=400, detail="Chat session ended. Please start a new session.")
+async def chat(input: UserInput) -> ChatResponse:
+    async with conversation_turn(input.conversation_id):
+        conversation = await get_or_create_conversation(input.conversation_id)
+        if not conversation.active:
+            raise HTTPException(status_code=400, detail="Chat session ended. Please start a new session.")
 
-    # Add user message
-    conversation.add(role=input.role, content=input.message)
+        cache_key, local_reply = await find_local_reply(conversation, input)
+        if local_reply is None:
+            # Fail fast before trimming, which may itself call Groq for a summary.
+            _check_groq_available()
 
-    # Get assistant reply
-    reply = query_groq_api(conversation)
+        # Add user message
+        conversation.add(role=input.role, content=input.message)
 
-    # Add assistant message to history
-    conversation.add(role="assistant", content=reply)
+        # Get assistant reply
+        if local_reply is not None:
+            reply = local_reply
+        else:
+            await trim_history(conversation)
+            reply = await query_groq_api(conversation)
+            if cache_key is not None:
+                response_cache[cache_key] = reply
+
+        # Add assistant message to history
+        conversation.add(role="assistant", content=reply)
+        await save_conversation(input.conversation_id, conversation)
+
+    return ChatResponse(response=reply, conversation_id=input.conversation_id)
+
+@app.post("/chat/stream/")
+async def chat_stream(input: UserInput):
+    try:
+        _check_groq_available()
+    except HTTPException:
+        # Groq is down; keep the 503 status unless this turn can be answered locally.
+        # Only this path peeks at the conversation outside the turn lock.
+        conversation = await get_or_create_conversation(input.conversation_id)
+        if (await find_local_reply(conversation, input))[1] is None:
+            raise
 
-    return {
-        "response": reply,
-        "conversation_id": input.conversation_id,
-    }
+    return StreamingResponse(stream_chat(input), media_type="text/event-stream")
 
 # -------- Local Dev Entry (optional) --------
 if __name__ == "__main__":
     import uvicorn
-    # 0.0.0.0 for Railway/containers; adjust port as needed
-    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")), reload=True)
\ No newline at end of file
+    # 0.0.0.0 for Railway/containers; adjust port as needed.
+    # Sessions are per-process, so keep WEB_CONCURRENCY at 1 unless REDIS_URL is set.
+    # Deployments run under gunicorn --preload instead (see Procfile).
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=False,
+    )
\ No newline at end of file
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import types
+
+import pytest
+
+import main
+
+# Changing the system prompt invalidates Groq's prompt prefix cache and every cached
+# reply; update this digest deliberately when the prompt is edited.
+SYSTEM_PROMPT_SHA256 = "808701a7b8aaa747fbae2366b63375c40b6cc13e04579caec3adc0ca53965128"
+
+
+def test_system_prompt_is_pinned():
+    assert hashlib.sha256(main.SYSTEM_PROMPT.encode("utf-8")).hexdigest() == SYSTEM_PROMPT_SHA256
+    assert main.SYSTEM_HASH == SYSTEM_PROMPT_SHA256
+
+
+def test_conversation_prefix_is_shared_prompt():
+    convo = main.Conversation()
+    convo.add("user", "When is Sabrang?")
+    convo.set_summary("Earlier the user asked about events.")
+    messages = convo.as_messages()
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"] is main.SYSTEM_PROMPT
+    main._check_prefix(messages)
+
+
+# -------- Helpers --------
+class WordEncoding:
+    """Deterministic stand-in for tiktoken: one token per whitespace-separated word."""
+
+    def encode(self, text):
+        return text.split()
+
+
+def _completion(content):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class StubCompletions:
+    def __init__(self, reply="summary text"):
+        self.reply = reply
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return _completion(self.reply)
+
+
+@pytest.fixture
+def stub_groq(monkeypatch):
+    completions = StubCompletions()
+    monkeypatch.setattr(main, "client", types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions)))
+    monkeypatch.setattr(main, "breaker", main.CircuitBreaker(failure_threshold=5, cooldown=30))
+    return completions
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(main, "_encoding", WordEncoding())
+    monkeypatch.setattr(main, "SYSTEM_TOKENS", 50)
+    monkeypatch.setattr(main, "HISTORY_TOKEN_BUDGET", 500)
+
+
+def _filled_conversation(turns, words):
+    convo = main.Conversation()
+    for i in range(turns):
+        convo.add("user" if i % 2 == 0 else "assistant", "w " * words)
+    return convo
+
+
+# -------- trim_history --------
+def test_trim_history_leaves_small_history_alone(word_tokens, stub_groq):
+    convo = _filled_conversation(4, 10)
+    asyncio.run(main.trim_history(convo))
+    assert len(convo.contents) == 4
+    assert convo.summary is None
+    assert stub_groq.calls == []
+
+
+def test_trim_history_drops_few_turns_without_summary(word_tokens, stub_groq):
+    convo = _filled_conversation(14, 30)  # 50 + 14 * 34 = 526 tokens
+    asyncio.run(main.trim_history(convo))
+    assert convo.total_tokens <= main.HISTORY_TOKEN_BUDGET
+    assert len(convo.contents) == 13
+    assert convo.summary is None
+    assert stub_groq.calls == []
+
+
+def test_trim_history_summarises_and_reserves_room(word_tokens, stub_groq):
+    stub_groq.reply = "sum " * 20
+    convo = _filled_conversation(26, 30)
+    asyncio.run(main.trim_history(convo))
+    assert len(stub_groq.calls) == 1
+    assert convo.summary == ("sum " * 20).strip()
+    assert convo.total_tokens <= main.HISTORY_TOKEN_BUDGET
+    # Second pass dropped extra turns to leave room for a maximum-length summary.
+    reserve = main.SUMMARY_MAX_TOKENS + main._count_tokens("Earlier summary: ")
+    assert convo.total_tokens - convo.summary_tokens <= main.HISTORY_TOKEN_BUDGET - reserve
+
+
+def test_trim_history_folds_into_existing_summary(word_tokens, stub_groq):
+    convo = _filled_conversation(2, 30)
+    convo.set_summary("the user asked about dance events")
+    convo.add("assistant", "w " * 400)
+    asyncio.run(main.trim_history(convo))
+    assert len(stub_groq.calls) == 1
+    transcript = stub_groq.calls[0]["messages"][1]["content"]
+    assert transcript.startswith("system: Earlier summary: the user asked about dance events")
+    assert convo.summary == "summary text"
+    assert convo.total_tokens <= main.HISTORY_TOKEN_BUDGET
+
+
+def test_trim_history_keeps_old_summary_when_summarising_fails(word_tokens, stub_groq):
+    stub_groq.reply = RuntimeError("boom")
+    convo = _filled_conversation(2, 30)
+    convo.set_summary("earlier chat")
+    convo.add("assistant", "w " * 300)
+    asyncio.run(main.trim_history(convo))
+    assert convo.summary == "earlier chat"
+    assert convo.total_tokens <= main.HISTORY_TOKEN_BUDGET
+
+
+def test_trim_history_drops_summary_as_last_resort(word_tokens, stub_groq):
+    convo = main.Conversation()
+    convo.set_summary("earlier chat")
+    convo.add("user", "w " * 440)  # newest message alone nearly fills the budget
+    asyncio.run(main.trim_history(convo))
+    assert convo.summary is None
+    assert len(convo.contents) == 1
+
+
+# -------- Batcher --------
+def test_batcher_fans_results_out_to_callers():
+    async def create(messages):
+        await asyncio.sleep(0.01)
+        if messages == "boom":
+            raise ValueError("boom")
+        return messages * 2
+
+    async def run():
+        batcher = main.Batcher(create, window_ms=5, max_size=4)
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(i) for i in range(6)), batcher.submit("boom"), return_exceptions=True
+            )
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(run())
+    assert results[:6] == [0, 2, 4, 6, 8, 10]
+    assert isinstance(results[6], ValueError)
+
+
+def test_batcher_skips_cancelled_callers():
+    async def create(messages):
+        await asyncio.sleep(0.01)
+        return messages
+
+    async def run():
+        batcher = main.Batcher(create, window_ms=20, max_size=4)
+        try:
+            cancelled = asyncio.create_task(batcher.submit("gone"))
+            kept = asyncio.create_task(batcher.submit("kept"))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            return await kept, cancelled
+        finally:
+            await batcher.close()
+
+    kept, cancelled = asyncio.run(run())
+    assert kept == "kept"
+    assert cancelled.cancelled()
+
+
+def test_batcher_zero_window_passes_through():
+    async def create(messages):
+        return messages
+
+    batcher = main.Batcher(create, window_ms=0, max_size=4)
+    assert asyncio.run(batcher.submit("direct")) == "direct"
+    assert batcher._worker is None
+
+
+# -------- CircuitBreaker --------
+def test_circuit_breaker_trips_and_reopens_after_cooldown(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    breaker = main.CircuitBreaker(failure_threshold=3, cooldown=30)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] += 29
+    assert not breaker.allow()
+    now[0] += 1
+    assert breaker.allow()  # trial call after the cooldown
+
+    breaker.record_success()
+    assert breaker.failures == 0 and breaker.opened_at is None
+
+
+def test_circuit_breaker_success_resets_failure_count():
+    breaker = main.CircuitBreaker(failure_threshold=2, cooldown=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+# -------- Conversation serialisation --------
+def test_conversation_json_round_trip(word_tokens):
+    convo = main.Conversation()
+    convo.add("user", "When is Sabrang?")
+    convo.add("assistant", "Soon!")
+    convo.set_summary("asked about dates")
+    convo.active = False
+
+    restored = main.Conversation.from_json(convo.to_json())
+
+    assert restored.as_messages() == convo.as_messages()
+    assert list(restored.token_counts) == list(convo.token_counts)
+    assert restored.summary_tokens == convo.summary_tokens
+    assert restored.active is False
+    assert restored.as_messages()[0]["content"] is main.SYSTEM_PROMPT
+
+
+def test_conversation_from_json_respects_max_history():
+    convo = main.Conversation()
+    for i in range(convo.max_history):
+        convo.add("user", f"m{i}")
+    restored = main.Conversation.from_json(convo.to_json())
+    restored.add("assistant", "newest")
+    assert len(restored.contents) == convo.max_history
+    assert restored.contents[-1] == "newest"